@@ -1,10 +1,26 @@
+# Launch with uvicorn directly (uvloop + httptools, one worker per core):
+#   uvicorn bot:app --host 0.0.0.0 --port $PORT --loop uvloop --http httptools --workers $(nproc)
+# Shared state lives in Redis and MEDIA_DIR downloads are flock-ed, so
+# multiple workers are safe. Don't run `python bot.py`: all the setup
+# below happens at import, so a script launcher would do it twice.
 import os
 import logging
 import asyncio
-from datetime import datetime
-
+import fcntl
+import shutil
+import time
+import uuid
+from contextlib import asynccontextmanager, suppress
+from pathlib import Path
+
+import aiofiles.os as aos
+import orjson
 import yt_dlp
+import redis.asyncio as aioredis
+from diskcache import Cache
 from fastapi import FastAPI, Request
+from fastapi.responses import ORJSONResponse
+from starlette.background import BackgroundTask
 from telegram import (
     Update,
     InputFile,
@@ -13,6 +29,7 @@ from telegram import (
     Bot,
 )
 from telegram.constants import ChatAction
+from telegram.request import HTTPXRequest
 
 # Logging
 logging.basicConfig(
@@ -24,6 +41,17 @@ logger = logging.getLogger(__name__)
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
 COOKIES_ENV = os.getenv("YT_COOKIES_FILES")
+# Optional local Bot API server (telegram-bot-api --local) sharing our disk,
+# e.g. http://localhost:8081
+BOT_API_URL = os.getenv("BOT_API_URL", "").rstrip("/")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+UPDATE_WORKERS = int(os.getenv("WORKERS", "4"))  # also max concurrent deliveries
+DELIVERY_BACKLOG = int(os.getenv("DELIVERY_BACKLOG", "32"))  # running + waiting
+FRAGMENT_WORKERS = int(os.getenv("FRAGMENT_WORKERS", "8"))
+QUALITY = int(os.getenv("QUALITY", "480"))  # default video height
+HD_QUALITY = 720
+FFMPEG_WORKERS = int(os.getenv("FFMPEG_WORKERS", "2"))
+YDL_POOL_SIZE = int(os.getenv("YDL_POOL_SIZE", "4"))
 
 # Cookies file
 COOKIES_FILE = "cookies.txt"
@@ -31,41 +59,464 @@ if COOKIES_ENV:
     with open(COOKIES_FILE, "w", encoding="utf-8") as f:
         f.write(COOKIES_ENV)
 
-# FastAPI
-app = FastAPI()
+# Caches
+CACHE_DIR = os.getenv("CACHE_DIR", ".cache")
+CACHE_TTL = 24 * 60 * 60  # 24h
+MEDIA_SWEEP_INTERVAL = 60 * 60  # also the grace period for in-progress files
+MEDIA_DIR = os.path.join(CACHE_DIR, "media")
+meta_cache = Cache(os.path.join(CACHE_DIR, "meta"))    # query -> video metadata
+file_cache = Cache(os.path.join(CACHE_DIR, "files"))   # video_id:kind -> file path
+
+# yt-dlp options: a flat ytsearch1: pass that only resolves the video id,
+# then a targeted download of that single video
+SEARCH_OPTS = {
+    "quiet": True,
+    "extract_flat": True,
+    "skip_download": True,
+}
+
+# Parallel downloads: DASH/HLS fragments are fetched concurrently by
+# yt-dlp itself; plain HTTP streams go through aria2c when it's installed
+DOWNLOAD_OPTS = {
+    "concurrent_fragment_downloads": FRAGMENT_WORKERS,
+    "http_chunk_size": 10 * 1024 * 1024,
+}
+if shutil.which("aria2c"):
+    DOWNLOAD_OPTS["external_downloader"] = {"http": "aria2c"}
+    DOWNLOAD_OPTS["external_downloader_args"] = {
+        "aria2c": ["-x", str(FRAGMENT_WORKERS), "-s", str(FRAGMENT_WORKERS), "-k", "1M"],
+    }
+
+# yt-dlp options for Telegram playable media. Audio is downloaded as-is
+# and transcoded by an ffmpeg subprocess (see transcode_audio).
+AUDIO_OPTS = {
+    "quiet": True,
+    "format": "bestaudio[ext=m4a]/bestaudio/best",
+    "outtmpl": os.path.join(MEDIA_DIR, "%(id)s-audio-src.%(ext)s"),
+    "restrictfilenames": True,
+    "cachedir": os.path.join(CACHE_DIR, "ytdlp"),
+    **DOWNLOAD_OPTS,
+    "postprocessors": [],
+}
+
+
+def _video_opts(height: int) -> dict:
+    return {
+        "quiet": True,
+        "format": (
+            f"bestvideo[height<={height}][vcodec^=avc1]+bestaudio[ext=m4a]"
+            f"/best[height<={height}][ext=mp4]/best[height<={height}]"
+        ),
+        "outtmpl": os.path.join(MEDIA_DIR, f"%(id)s-video{height}.%(ext)s"),
+        "merge_output_format": "mp4",
+        "restrictfilenames": True,
+        "cachedir": os.path.join(CACHE_DIR, "ytdlp"),
+        **DOWNLOAD_OPTS,
+    }
+
+
+VIDEO_OPTS = _video_opts(QUALITY)
+HD_VIDEO_OPTS = _video_opts(HD_QUALITY)
+
+if os.path.exists(COOKIES_FILE):
+    for opts in (SEARCH_OPTS, AUDIO_OPTS, VIDEO_OPTS, HD_VIDEO_OPTS):
+        opts["cookiefile"] = COOKIES_FILE
+
+# A small pool of long-lived YoutubeDL instances per profile keeps their
+# HTTP sessions (and TLS connections) alive between requests. YoutubeDL
+# isn't thread-safe, so each instance is checked out by one job at a time.
+YDL_OPTS = {
+    "search": SEARCH_OPTS,
+    "audio": AUDIO_OPTS,
+    "video": VIDEO_OPTS,
+    "video_hd": HD_VIDEO_OPTS,
+}
+YDL_POOLS = {kind: asyncio.Queue() for kind in YDL_OPTS}
+YDL_INSTANCES = []
+for kind, opts in YDL_OPTS.items():
+    for _ in range(YDL_POOL_SIZE):
+        ydl = yt_dlp.YoutubeDL(opts)
+        YDL_INSTANCES.append(ydl)
+        YDL_POOLS[kind].put_nowait(ydl)
+
+# ffmpeg already runs in its own process; this only caps concurrent transcodes
+ffmpeg_slots = asyncio.Semaphore(FFMPEG_WORKERS)
 
-# Standalone bot instance
-bot = Bot(token=BOT_TOKEN)
+# FastAPI
+app = FastAPI(default_response_class=ORJSONResponse)
+
+# Standalone bot instance; long timeouts so large media uploads don't abort
+UPLOAD_TIMEOUT = 120
+bot_api = {}
+if BOT_API_URL:
+    bot_api = {
+        "base_url": f"{BOT_API_URL}/bot",
+        "base_file_url": f"{BOT_API_URL}/file/bot",
+        "local_mode": True,
+    }
+bot = Bot(
+    token=BOT_TOKEN,
+    request=HTTPXRequest(
+        connection_pool_size=20,
+        read_timeout=UPLOAD_TIMEOUT,
+        write_timeout=UPLOAD_TIMEOUT,
+    ),
+    **bot_api,
+)
 
-# Track users and pending songs
-monthly_users = set()
-pending_songs = {}  # user_id -> song_name
+# Track users and pending songs in Redis so every worker shares them:
+#   pending:<user_id> -> song_name (expires after an hour)
+#   mau:<YYYY-MM>     -> HyperLogLog of user ids
+redis = aioredis.from_url(REDIS_URL, decode_responses=True)
+PENDING_TTL = 60 * 60
+MAU_TTL = 62 * 24 * 60 * 60
+inflight = {}  # kind:query / kind:video_id -> Future shared by identical requests
+
+# Incoming updates are buffered here and drained by UPDATE_WORKERS workers
+update_queue = asyncio.Queue(maxsize=256)
+update_workers = []
+background_tasks = []
+option_tasks = set()  # running handle_option tasks, kept so they aren't GC'd
+download_slots = asyncio.Semaphore(UPDATE_WORKERS)
+
+
+# Song options keyboard, built once and reused for every reply
+CHOICE_MARKUP = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("🎵 Music", callback_data="music"),
+        InlineKeyboardButton("🎬 Video", callback_data="video"),
+        InlineKeyboardButton("🎶 Both", callback_data="both"),
+    ],
+    [
+        InlineKeyboardButton(f"🎬 HD Video ({HD_QUALITY}p)", callback_data="hd"),
+    ],
+])
+CHOICE_LABELS = {
+    "hd": f"HD video ({HD_QUALITY}p)",
+}
+
+
+# Helper: greeting, precomputed per IST hour
+GREETINGS = tuple(
+    "🌅 Good Morning" if 5 <= h < 12
+    else "🌞 Good Afternoon" if 12 <= h < 17
+    else "🌇 Good Evening" if 17 <= h < 21
+    else "🌙 Good Night"
+    for h in range(24)
+)
 
 
-# Helper: greeting
 def get_greeting(username: str) -> str:
-    hour = (datetime.utcnow().hour + 5.5) % 24  # IST
-    hour = int(hour)
-    if 5 <= hour < 12:
-        greeting = "🌅 Good Morning"
-    elif 12 <= hour < 17:
-        greeting = "🌞 Good Afternoon"
-    elif 17 <= hour < 21:
-        greeting = "🌇 Good Evening"
-    else:
-        greeting = "🌙 Good Night"
+    hour = int(time.time() / 3600 + 5.5) % 24  # IST
+    greeting = GREETINGS[hour]
     return f"{greeting}, @{username}!"
 
 
+# Helper: monthly active users, one HyperLogLog key per month
+def _mau_key() -> str:
+    return "mau:" + time.strftime("%Y-%m", time.gmtime())
+
+
+async def track_user(user_id: int):
+    key = _mau_key()
+    async with redis.pipeline(transaction=False) as pipe:
+        pipe.pfadd(key, user_id)
+        pipe.expire(key, MAU_TTL)
+        await pipe.execute()
+
+
 # Helper: typing indicator
 async def send_typing(chat_id: int):
     await bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
 
 
+# Helper: media uploads
+async def load_media(path: str):
+    # A local Bot API server reads the file from disk itself, so we only
+    # send its file:// URI instead of uploading the bytes
+    if BOT_API_URL:
+        return Path(path).absolute()
+    # PTB reads the whole file into the multipart body anyway; do that read
+    # in a thread instead of on the event loop
+    data = await asyncio.to_thread(Path(path).read_bytes)
+    return InputFile(data, filename=os.path.basename(path))
+
+
+async def send_audio_file(chat_id: int, path: str, title: str, caption: str):
+    # send_audio's own write_timeout default (20s) overrides the request's
+    await bot.send_audio(
+        chat_id=chat_id,
+        audio=await load_media(path),
+        title=title,
+        caption=caption,
+        read_timeout=UPLOAD_TIMEOUT,
+        write_timeout=UPLOAD_TIMEOUT,
+    )
+
+
+async def send_video_file(chat_id: int, path: str, caption: str):
+    await bot.send_video(
+        chat_id=chat_id,
+        video=await load_media(path),
+        caption=caption,
+        read_timeout=UPLOAD_TIMEOUT,
+        write_timeout=UPLOAD_TIMEOUT,
+    )
+
+
+# Helper: yt-dlp search/download (runs in a worker thread)
+@asynccontextmanager
+async def _checkout_ydl(kind: str):
+    pool = YDL_POOLS[kind]
+    ydl = await pool.get()
+    try:
+        yield ydl
+    finally:
+        pool.put_nowait(ydl)
+
+
+def _sync_search(ydl: yt_dlp.YoutubeDL, query: str) -> dict:
+    info = ydl.extract_info(query, download=False)
+    return info["entries"][0]
+
+
+def _sync_extract(ydl: yt_dlp.YoutubeDL, query: str):
+    info = ydl.extract_info(query, download=True)
+    if "entries" in info:
+        info = info["entries"][0]
+    filename = ydl.prepare_filename(info)
+    return filename, info
+
+
+async def _ydl_extract(kind: str, query: str):
+    async with _checkout_ydl(kind) as ydl:
+        return await asyncio.to_thread(_sync_extract, ydl, query)
+
+
+async def _ydl_search(query: str) -> dict:
+    async with _checkout_ydl("search") as ydl:
+        return await asyncio.to_thread(_sync_search, ydl, query)
+
+
+# Helper: audio transcode (ffmpeg subprocess)
+async def transcode_audio(src: str) -> str:
+    dst = src.replace("-audio-src.", "-audio.").rsplit(".", 1)[0] + ".m4a"
+    # Write to a private temp name and swap it in atomically, so a file that
+    # is being uploaded is never truncated by a concurrent transcode
+    tmp = f"{dst[:-len('.m4a')]}.{uuid.uuid4().hex}.tmp.m4a"
+    try:
+        async with ffmpeg_slots:
+            proc = await asyncio.create_subprocess_exec(
+                "ffmpeg", "-y", "-loglevel", "error", "-i", src,
+                "-vn", "-c:a", "aac", "-b:a", "96k", "-movflags", "+faststart", tmp,
+            )
+            try:
+                returncode = await proc.wait()
+            except asyncio.CancelledError:
+                proc.kill()
+                await proc.wait()
+                raise
+        if returncode != 0:
+            raise RuntimeError(f"ffmpeg exited with status {returncode}")
+        await aos.replace(tmp, dst)
+    finally:
+        with suppress(FileNotFoundError):
+            await aos.remove(tmp)
+        with suppress(FileNotFoundError):
+            await aos.remove(src)
+    return dst
+
+
+# Helper: media eviction. Expiring a file_cache entry only drops its row,
+# so files no live entry points to are removed from MEDIA_DIR periodically.
+def _sync_sweep_media() -> int:
+    file_cache.expire()
+    live = {os.path.abspath(p) for p in map(file_cache.get, list(file_cache)) if p}
+    cutoff = time.time() - MEDIA_SWEEP_INTERVAL
+    removed = 0
+    if not os.path.isdir(MEDIA_DIR):
+        return removed
+    for entry in os.scandir(MEDIA_DIR):
+        path = os.path.abspath(entry.path)
+        try:
+            # Recent files may still be downloading or transcoding; lock
+            # files are touched whenever they're taken
+            if not entry.is_file() or path in live or entry.stat().st_mtime > cutoff:
+                continue
+            os.remove(path)
+            removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
+
+
+async def media_sweeper():
+    while True:
+        await asyncio.sleep(MEDIA_SWEEP_INTERVAL)
+        try:
+            removed = await asyncio.to_thread(_sync_sweep_media)
+            logger.info(f"Media sweep removed {removed} file(s).")
+        except Exception as e:
+            logger.error(f"Error sweeping media: {e}")
+
+
+# Helper: cached search + download
+def _query_key(song_name: str) -> str:
+    return " ".join(song_name.lower().split())
+
+
+class _OwnerCancelled(Exception):
+    pass
+
+
+async def _coalesce(key: str, make_coro):
+    # Run make_coro() once per key; concurrent callers share its result.
+    # If the owner is cancelled, a waiter takes over instead of failing.
+    while (fut := inflight.get(key)) is not None:
+        try:
+            return await asyncio.shield(fut)
+        except _OwnerCancelled:
+            continue
+
+    fut = asyncio.get_running_loop().create_future()
+    inflight[key] = fut
+    try:
+        result = await make_coro()
+        fut.set_result(result)
+        return result
+    except asyncio.CancelledError:
+        fut.set_exception(_OwnerCancelled())
+        fut.exception()
+        raise
+    except Exception as e:
+        fut.set_exception(e)
+        fut.exception()  # don't warn when nobody else was waiting
+        raise
+    finally:
+        inflight.pop(key, None)
+
+
+@asynccontextmanager
+async def _media_lock(name: str):
+    # inflight only coalesces within one process; uvicorn workers share
+    # MEDIA_DIR, so downloads of the same file also take an flock on it.
+    # Polled with LOCK_NB so waiting stays cancellable.
+    await aos.makedirs(MEDIA_DIR, exist_ok=True)
+    fd = os.open(os.path.join(MEDIA_DIR, f".{name}.lock"), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                await asyncio.sleep(0.5)
+        os.utime(fd)  # keep media_sweeper off a lock that's in use
+        try:
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+    finally:
+        os.close(fd)
+
+
+async def _download_media(kind: str, meta: dict) -> str:
+    cache_key = f"{meta['id']}:{kind}"
+    path = await asyncio.to_thread(file_cache.get, cache_key)
+    if path and await aos.path.exists(path):
+        return path
+
+    async with _media_lock(f"{meta['id']}-{kind}"):
+        # Another worker may have finished this file while we waited
+        path = await asyncio.to_thread(file_cache.get, cache_key)
+        if path and await aos.path.exists(path):
+            return path
+
+        path, _ = await _ydl_extract(kind, meta["url"])
+        if kind == "audio":
+            path = await transcode_audio(path)
+        await asyncio.to_thread(file_cache.set, cache_key, path, expire=CACHE_TTL)
+    return path
+
+
+async def _fetch_media(kind: str, song_name: str):
+    key = _query_key(song_name)
+    # diskcache is synchronous SQLite, so keep it off the event loop
+    meta = await asyncio.to_thread(meta_cache.get, key)
+    if not meta:
+        entry = await _ydl_search(f"ytsearch1:{song_name}")
+        meta = {
+            "id": entry["id"],
+            "url": f"https://youtu.be/{entry['id']}",
+            "title": entry.get("title"),
+            "duration": entry.get("duration"),
+        }
+        await asyncio.to_thread(meta_cache.set, key, meta, expire=CACHE_TTL)
+
+    # Differently worded queries can resolve to the same video, so the
+    # download itself is coalesced on the video id
+    path = await _coalesce(f"{kind}:id:{meta['id']}", lambda: _download_media(kind, meta))
+    return path, meta
+
+
+async def fetch_media(kind: str, song_name: str):
+    # Coalesce identical in-flight requests into a single search + download
+    key = f"{kind}:q:{_query_key(song_name)}"
+    return await _coalesce(key, lambda: _fetch_media(kind, song_name))
+
+
+# Helper: like gather, but a failure cancels and awaits the sibling tasks so
+# nothing keeps running (or arrives) after we've reported the error
+async def _gather_or_cancel(*aws):
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+# Helper: download the chosen media and send it to the chat
+async def deliver_media(chat_id: int, user_id: int, choice: str, song_name: str):
+    audio_path = video_path = None
+
+    try:
+        if choice == "music":
+            audio_path, info = await fetch_media("audio", song_name)
+        elif choice == "video":
+            video_path, info = await fetch_media("video", song_name)
+        elif choice == "hd":
+            video_path, info = await fetch_media("video_hd", song_name)
+        else:
+            # Fetch audio and video concurrently
+            (audio_path, info), (video_path, _) = await _gather_or_cancel(
+                fetch_media("audio", song_name),
+                fetch_media("video", song_name),
+            )
+
+        caption = f"✅ {info.get('title')}"
+
+        # Uploads run in parallel; the caption replaces a separate "Delivered" message
+        uploads = []
+        if audio_path:
+            uploads.append(send_audio_file(chat_id, audio_path, info.get("title"), caption))
+        if video_path:
+            uploads.append(send_video_file(chat_id, video_path, caption))
+        await _gather_or_cancel(*uploads)
+
+        # Downloaded files stay in MEDIA_DIR for file_cache; media_sweeper evicts them
+        await redis.delete(f"pending:{user_id}")
+
+    except Exception as e:
+        logger.error(f"Error downloading {song_name}: {e}")
+        await bot.send_message(chat_id=chat_id, text="❌ Failed to fetch the song. Please try again.")
+
+
 # Handlers
 async def start(update: Update):
     user_id = update.effective_user.id
-    monthly_users.add(user_id)
+    await track_user(user_id)
 
     username = update.effective_user.username or update.effective_user.first_name
     greeting = get_greeting(username)
@@ -79,21 +530,12 @@ async def start(update: Update):
 async def handle_song_name(update: Update):
     user_id = update.effective_user.id
     song_name = update.message.text
-    pending_songs[user_id] = song_name
-
-    keyboard = [
-        [
-            InlineKeyboardButton("🎵 Music", callback_data="music"),
-            InlineKeyboardButton("🎬 Video", callback_data="video"),
-            InlineKeyboardButton("🎶 Both", callback_data="both"),
-        ]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    await redis.set(f"pending:{user_id}", song_name, ex=PENDING_TTL)
 
     await bot.send_message(
         chat_id=update.effective_chat.id,
         text=f"Select what to receive for *{song_name}*:",
-        reply_markup=reply_markup
+        reply_markup=CHOICE_MARKUP
     )
 
 
@@ -102,7 +544,7 @@ async def handle_option(update: Update):
     await query.answer()
     choice = query.data
     user_id = query.from_user.id
-    song_name = pending_songs.get(user_id)
+    song_name = await redis.get(f"pending:{user_id}")
 
     if not song_name:
         await bot.edit_message_text(
@@ -115,121 +557,114 @@ async def handle_option(update: Update):
     await bot.edit_message_text(
         chat_id=query.message.chat.id,
         message_id=query.message.message_id,
-        text=f"⏳ Downloading {choice} for *{song_name}*..."
+        text=f"⏳ Downloading {CHOICE_LABELS.get(choice, choice)} for *{song_name}*..."
     )
-    await send_typing(query.message.chat.id)
-
-    # yt-dlp options for Telegram playable media
-    if choice == "music":
-        ydl_opts = {
-            "quiet": True,
-            "format": "bestaudio[ext=m4a]/bestaudio/best",
-            "outtmpl": "%(title)s.%(ext)s",
-            "restrictfilenames": True,
-            "postprocessors": [{
-                "key": "FFmpegExtractAudio",
-                "preferredcodec": "mp3",
-                "preferredquality": "192",
-            }],
-        }
-    elif choice == "video":
-        ydl_opts = {
-            "quiet": True,
-            "format": "bestvideo[ext=mp4][height<=720]+bestaudio[ext=m4a]/best[ext=mp4]",
-            "outtmpl": "%(title)s.%(ext)s",
-            "merge_output_format": "mp4",
-            "restrictfilenames": True,
-        }
-    else:
-        ydl_opts = {
-            "quiet": True,
-            "format": "bestvideo[ext=mp4][height<=720]+bestaudio[ext=m4a]/best[ext=mp4]",
-            "outtmpl": "%(title)s.%(ext)s",
-            "merge_output_format": "mp4",
-            "restrictfilenames": True,
-        }
 
-    if os.path.exists(COOKIES_FILE):
-        ydl_opts["cookiefile"] = COOKIES_FILE
+    # Only the download + upload is limited; answering the callback and the
+    # status edit above never wait for a free slot
+    async with download_slots:
+        # Typing only lasts a few seconds, so send it once we actually start
+        await send_typing(query.message.chat.id)
+        await deliver_media(query.message.chat.id, user_id, choice, song_name)
 
-    try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(f"ytsearch1:{song_name}", download=True)
-            if "entries" in info:
-                info = info["entries"][0]
-            filename = ydl.prepare_filename(info)
-
-        chat_id = query.message.chat.id
-
-        if choice in ("music", "both"):
-            await bot.send_audio(
-                chat_id=chat_id,
-                audio=InputFile(filename),
-                title=info.get("title"),
-            )
 
-        if choice in ("video", "both"):
-            await bot.send_video(
-                chat_id=chat_id,
-                video=InputFile(filename),
-                caption=info.get("title"),
-            )
-
-        await bot.send_message(chat_id=chat_id, text=f"✅ Delivered: {info.get('title')}")
+async def stats(update: Update):
+    await bot.send_message(
+        chat_id=update.effective_chat.id,
+        text=f"📊 Monthly active users: {await redis.pfcount(_mau_key())}"
+    )
 
-        # Clean up
-        if os.path.exists(filename):
-            os.remove(filename)
 
-        pending_songs.pop(user_id, None)
+# Command dispatch; anything else is treated as a song name
+COMMANDS = {
+    "/start": start,
+    "/stats": stats,
+}
+
+
+async def process_update(update: Update):
+    if update.message:
+        # Stickers, photos etc. carry no text and aren't song names
+        if not update.message.text or not update.message.text.strip():
+            return
+        command = update.message.text.split(maxsplit=1)[0].split("@", 1)[0]
+        handler = COMMANDS.get(command, handle_song_name)
+        await handler(update)
+    elif update.callback_query:
+        # Song picks can take minutes; run them outside the update workers
+        # so /start and song-name replies aren't stuck behind downloads.
+        # The number of running + waiting picks is capped; past that we shed.
+        if len(option_tasks) >= DELIVERY_BACKLOG:
+            logger.warning(f"Delivery backlog full, shedding update {update.update_id}")
+            await update.callback_query.answer(
+                "⏳ The bot is busy right now. Please try again in a minute.",
+                show_alert=True,
+            )
+            return
+        task = asyncio.create_task(handle_option(update))
+        option_tasks.add(task)
+        task.add_done_callback(_option_done)
 
-    except Exception as e:
-        logger.error(f"Error downloading {song_name}: {e}")
-        await bot.send_message(chat_id=query.message.chat.id, text="❌ Failed to fetch the song. Please try again.")
 
+def _option_done(task: asyncio.Task):
+    option_tasks.discard(task)
+    if not task.cancelled() and task.exception():
+        logger.error(f"Error processing update: {task.exception()}")
 
-async def stats(update: Update):
-    await bot.send_message(
-        chat_id=update.effective_chat.id,
-        text=f"📊 Monthly active users: {len(monthly_users)}"
-    )
 
+async def update_worker():
+    while True:
+        update = await update_queue.get()
+        try:
+            await process_update(update)
+        except Exception as e:
+            logger.error(f"Error processing update: {e}")
+        finally:
+            update_queue.task_done()
 
-# Webhook route
-@app.post("/webhook")
-async def telegram_webhook(request: Request):
-    data = await request.json()
-    update = Update.de_json(data, bot)
 
-    # Directly call handlers
+async def enqueue_update(raw: bytes):
     try:
-        if update.message:
-            if update.message.text == "/start":
-                asyncio.create_task(start(update))
-            elif update.message.text == "/stats":
-                asyncio.create_task(stats(update))
-            else:
-                asyncio.create_task(handle_song_name(update))
-        elif update.callback_query:
-            asyncio.create_task(handle_option(update))
+        update = Update.de_json(orjson.loads(raw), bot)
     except Exception as e:
-        logger.error(f"Error processing update: {e}")
+        logger.error(f"Error parsing update: {e}")
+        return
 
-    return {"ok": True}
+    try:
+        update_queue.put_nowait(update)
+    except asyncio.QueueFull:
+        logger.warning(f"Update queue full, dropping update {update.update_id}")
+
+
+# Webhook route: ACK first, parse and enqueue once the response is sent
+@app.post("/webhook")
+async def telegram_webhook(request: Request):
+    raw = await request.body()
+    return ORJSONResponse({"ok": True}, background=BackgroundTask(enqueue_update, raw))
 
 
 @app.on_event("startup")
 async def startup_event():
+    update_workers.extend(asyncio.create_task(update_worker()) for _ in range(UPDATE_WORKERS))
+    background_tasks.append(asyncio.create_task(media_sweeper()))
     await bot.set_webhook(url=f"{WEBHOOK_URL}/webhook")
     logger.info("Webhook set.")
 
 
 @app.on_event("shutdown")
 async def shutdown_event():
+    tasks = update_workers + background_tasks + list(option_tasks)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
     await bot.delete_webhook()
+    for ydl in YDL_INSTANCES:
+        ydl.close()
+    await redis.aclose()
     logger.info("Webhook removed.")
 
 
 @app.get("/")
 async def root():
     return {"status": "Bot is alive ✅"}
+